@@ -0,0 +1,127 @@
+# fast_telethon.py
+# Minimal FastTelethon-style downloader: several MTProto connections to the
+# file's DC, each pulling its own byte range with GetFileRequest.
+import asyncio
+from collections import defaultdict
+from typing import Dict, Optional
+
+from telethon.crypto import AuthKey
+from telethon.errors import FloodWaitError
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions.upload import GetFileRequest
+
+PART_SIZE = 512 * 1024
+PART_FLOOD_RETRIES = 5  # consecutive FloodWaits on one part before giving up on the file
+
+# Auth keys authorized on foreign DCs, reused so each DC is exported at most once per run
+_exported_keys: Dict[int, AuthKey] = {}
+_export_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _known_auth_key(client, dc_id: int) -> Optional[AuthKey]:
+    if dc_id == client.session.dc_id:
+        return client.session.auth_key
+    if dc_id in _exported_keys:
+        return _exported_keys[dc_id]
+    # A sender the client already borrowed for this DC is authorized there too
+    _state, held = client._borrowed_senders.get(dc_id, (None, None))
+    return held.auth_key if held is not None and held.auth_key else None
+
+
+async def _connect_sender(client, dc_id: int, auth_key: Optional[AuthKey], throttle=None) -> MTProtoSender:
+    dc = await client._get_dc(dc_id)
+    sender = MTProtoSender(auth_key, loggers=client._log)
+    try:
+        await sender.connect(
+            client._connection(dc.ip_address, dc.port, dc.id, loggers=client._log, proxy=client._proxy)
+        )
+        if auth_key is None:
+            if throttle is not None:
+                await throttle.acquire()
+            auth = await client(ExportAuthorizationRequest(dc_id))
+            client._init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+            await sender.send(InvokeWithLayerRequest(LAYER, client._init_request))
+            _exported_keys[dc_id] = sender.auth_key
+    except BaseException:
+        await sender.disconnect()
+        raise
+    return sender
+
+
+async def _create_sender(client, dc_id: int, throttle=None) -> MTProtoSender:
+    auth_key = _known_auth_key(client, dc_id)
+    if auth_key is None:
+        # Only one task exports per DC; the others wait and reuse its key
+        async with _export_locks[dc_id]:
+            auth_key = _known_auth_key(client, dc_id)
+            if auth_key is None:
+                return await _connect_sender(client, dc_id, None, throttle)
+    return await _connect_sender(client, dc_id, auth_key)
+
+
+async def download_file(
+    client, location, out, dc_id: int, size: int, workers: int = 4, part_size: int = PART_SIZE, throttle=None
+):
+    """Download `size` bytes of `location` into the seekable async file `out`.
+
+    `throttle`, if given, needs `async acquire()`, `note_success()` and
+    `slow_down()`; it is charged once per GetFile and per auth export.
+    """
+    parts = -(-size // part_size)
+    workers = max(1, min(workers, parts))
+    per_sender = -(-parts // workers)
+    write_lock = asyncio.Lock()
+
+    # The first sender may export auth; the rest reuse its key
+    senders = [await _create_sender(client, dc_id, throttle)]
+    try:
+        extra = await asyncio.gather(
+            *(_create_sender(client, dc_id, throttle) for _ in range(workers - 1)), return_exceptions=True
+        )
+        senders += [s for s in extra if isinstance(s, MTProtoSender)]
+        for s in extra:
+            if isinstance(s, BaseException):
+                raise s
+
+        async def _range(sender: MTProtoSender, first_part: int):
+            offset = first_part * part_size
+            end = min(size, (first_part + per_sender) * part_size)
+            floods = 0
+            while offset < end:
+                if throttle is not None:
+                    await throttle.acquire()
+                try:
+                    result = await sender.send(GetFileRequest(location, offset=offset, limit=part_size))
+                except FloodWaitError as e:
+                    # Raw senders don't auto-sleep; wait here and retry this part only
+                    floods += 1
+                    if floods > PART_FLOOD_RETRIES:
+                        raise
+                    if throttle is not None:
+                        throttle.slow_down()
+                    await asyncio.sleep(e.seconds + 0.5)
+                    continue
+                floods = 0
+                if throttle is not None:
+                    throttle.note_success()
+                if not result.bytes:
+                    break
+                async with write_lock:
+                    await out.seek(offset)
+                    await out.write(result.bytes)
+                offset += part_size
+
+        tasks = [asyncio.create_task(_range(s, i * per_sender)) for i, s in enumerate(senders)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Don't keep requesting parts while the caller handles the error
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    finally:
+        await asyncio.gather(*(s.disconnect() for s in senders), return_exceptions=True)
@@ -1,14 +1,20 @@
 # telegram_media_downloader.py
 import os
-import re
+import sys
 import json
+import time
+import array
+import shutil
 import asyncio
 from pathlib import Path
-from typing import Dict, Set
+from typing import AsyncIterator, Dict, Set, Tuple
 
-from telethon import TelegramClient
-from telethon.tl.types import MessageMediaPhoto, DocumentAttributeVideo
+import aiofiles
+from sortedcontainers import SortedList
+from telethon import TelegramClient, utils
+from telethon.tl.types import Message, MessageMediaPhoto, DocumentAttributeVideo
 from telethon.errors import FloodWaitError
+from telethon.tl.functions.auth import ExportAuthorizationRequest
 from telethon.tl.functions.messages import ImportChatInviteRequest
 from telethon.errors import UserAlreadyParticipantError
 
@@ -26,20 +32,37 @@ from rich.progress import (
     TextColumn,
 )
 
+import fast_telethon
+
 # ===================== CONFIG =====================
 CONFIG_FILE = "config.json"
-SESSION_NAME = "session"
+SESSION_DIR = Path.home() / ".telesave"
+SESSION_NAME = str(SESSION_DIR / "session")  # Telethon appends .session
 BASE_DOWNLOADS = Path("downloads")
+DEFAULT_WORKERS = 4  # parallel downloads per run
+PART_SIZE = 512 * 1024  # bytes per GetFile request
+FAST_DOWNLOAD_THRESHOLD = 1024 * 1024  # files above this are fetched in parallel parts
+MULTI_SENDER_THRESHOLD = 5 * 1024 * 1024  # documents above this get their own connections
+DEFAULT_RATE = 300  # GetFile/ExportAuthorization requests per RATE_PERIOD, shared by all workers
+RATE_PERIOD = 30  # seconds
+RATE_RECOVER_AFTER = 50  # clean requests before a slowed-down rate doubles again
+FLOOD_RETRIES = 5
+PROGRESS_TICK = 0.5  # seconds between progress bar updates
+LOG_FSYNC_EVERY = 20  # flush the append log to disk every N downloads
+LOG_COMPACT_EVERY = 1000  # fold the append log into _downloaded.ids every N downloads
 
 console = Console()
 
+_FS_TRANS = str.maketrans({c: "_" for c in '\\/:*?"<>|\n\r\t'})
+
 
 # ===================== UTILITIES =====================
 def load_config() -> Dict:
-    if os.path.exists(CONFIG_FILE):
+    try:
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             return json.load(f)
-    return {}
+    except FileNotFoundError:
+        return {}
 
 
 def save_config(api_id: int, api_hash: str):
@@ -51,8 +74,7 @@ def sanitize_for_fs(name: str) -> str:
     """Make a clean folder name for the filesystem."""
     if not name:
         return "chat"
-    name = re.sub(r"[\\/:*?\"<>|\n\r\t]", "_", name)
-    name = re.sub(r"\s+", " ", name).strip()
+    name = " ".join(name.translate(_FS_TRANS).split())
     return name[:80]  # keep it tidy
 
 
@@ -65,13 +87,9 @@ def is_video_message(msg) -> bool:
         return False
     if getattr(msg, "video", None):
         return True
-    doc = getattr(msg, "document", None)
-    if not doc:
-        return False
-    for attr in getattr(doc, "attributes", []) or []:
-        if isinstance(attr, DocumentAttributeVideo):
-            return True
-    return False
+    attrs = getattr(getattr(msg, "document", None), "attributes", None) or ()
+    # TL objects are concrete final classes, so an identity check is enough
+    return any(type(attr) is DocumentAttributeVideo for attr in attrs)
 
 
 def choose_chat_folder(chat) -> Path:
@@ -91,30 +109,86 @@ def per_chat_log_path(chat_folder: Path) -> Path:
     return chat_folder / "_downloaded.json"
 
 
-def load_downloaded_set(chat_folder: Path) -> Set[int]:
-    log_path = per_chat_log_path(chat_folder)
-    if log_path.exists():
-        try:
-            with open(log_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                ids = data.get("downloaded_ids", [])
-                return set(int(x) for x in ids)
-        except Exception:
-            return set()
-    return set()
+def per_chat_ids_path(chat_folder: Path) -> Path:
+    """Downloaded message IDs as a packed little-endian uint64 array."""
+    return chat_folder / "_downloaded.ids"
 
 
-def save_downloaded_set(chat_folder: Path, msg_ids: Set[int], chat_meta: Dict):
+def per_chat_append_log_path(chat_folder: Path) -> Path:
+    """One message ID per line, appended as files finish; folded into the ID array on save."""
+    return chat_folder / "_downloaded.log"
+
+
+def load_downloaded_set(chat_folder: Path) -> Set[int]:
+    ids: Set[int] = set()
+    try:
+        data = json.loads(per_chat_log_path(chat_folder).read_bytes())
+        # Older logs kept the IDs in the JSON itself
+        ids.update(data.get("downloaded_ids", []))
+    except Exception:  # missing or unreadable
+        pass
+    try:
+        packed = array.array("Q")
+        packed.frombytes(per_chat_ids_path(chat_folder).read_bytes())
+        if sys.byteorder != "little":
+            packed.byteswap()
+        ids.update(packed)
+    except (FileNotFoundError, ValueError):  # missing or not a whole number of IDs
+        pass
+    try:
+        with open(per_chat_append_log_path(chat_folder), "r", encoding="utf-8") as f:
+            for line in f:
+                # A line without its newline was cut off mid-write; don't trust it
+                if not line.endswith("\n") or not line.strip():
+                    continue
+                try:
+                    ids.add(int(line))
+                except ValueError:  # garbled line; keep the rest
+                    pass
+    except FileNotFoundError:
+        pass
+    return ids
+
+
+def open_append_log(chat_folder: Path):
+    """Open the append log, first dropping a torn last line left by a crash."""
+    append_path = per_chat_append_log_path(chat_folder)
+    try:
+        with open(append_path, "r+b") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+    except FileNotFoundError:
+        pass
+    return open(append_path, "a", encoding="utf-8", buffering=1)
+
+
+def save_downloaded_set(chat_folder: Path, msg_ids: SortedList, chat_meta: Dict):
+    """Compact everything into the ID array, then empty the append log."""
+    packed = array.array("Q", msg_ids)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    ids_path = per_chat_ids_path(chat_folder)
+    temp = ids_path.with_name(ids_path.name + ".tmp")
+    with open(temp, "wb") as f:
+        packed.tofile(f)
+    os.replace(temp, ids_path)
+
     log_path = per_chat_log_path(chat_folder)
     payload = {
         "chat_id": chat_meta.get("id"),
         "chat_name": chat_meta.get("name"),
-        "downloaded_ids": sorted(list(msg_ids)),
     }
-    temp = log_path.with_suffix(".tmp")
+    temp = log_path.with_name(log_path.name + ".tmp")
     with open(temp, "w", encoding="utf-8") as f:
         json.dump(payload, f, indent=2)
     os.replace(temp, log_path)
+    open(per_chat_append_log_path(chat_folder), "w").close()
+
+
+def snapshot_existing_files(chat_folder: Path) -> Set[Tuple[Path, str]]:
+    """(directory, filename) for every file already under the chat folder, in one walk."""
+    return {(Path(root), name) for root, _dirs, files in os.walk(chat_folder) for name in files}
 
 
 def build_unique_filename(msg, default_ext: str = ".bin") -> str:
@@ -127,30 +201,177 @@ def build_unique_filename(msg, default_ext: str = ".bin") -> str:
     return f"msg_{msg.id}_{base}"
 
 
+# ===================== RATE LIMITING =====================
+class AsyncTokenBucket:
+    """Allow at most `rate` acquisitions every `per` seconds, shared across tasks.
+
+    The rate drops when the server floods us and climbs back to where it started
+    once requests go through cleanly again.
+    """
+
+    def __init__(self, rate: float, per: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.per = per
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._successes = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+
+    def slow_down(self, factor: float = 0.5):
+        """Shrink the rate after the server pushed back; never below 1 per period."""
+        self.rate = max(1, self.rate * factor)
+        self._tokens = min(self._tokens, self.rate)
+        self._successes = 0
+
+    def note_success(self):
+        """Count a request that went through; a clean streak doubles a reduced rate."""
+        if self.rate >= self.max_rate:
+            return
+        self._successes += 1
+        if self._successes >= RATE_RECOVER_AFTER:
+            self.rate = min(self.max_rate, self.rate * 2)
+            self._successes = 0
+
+
+async def with_antiflood(call, bucket: AsyncTokenBucket, retries: int = FLOOD_RETRIES, charge: bool = True):
+    """Run `call()`, sleeping out FloodWaits and retrying.
+
+    With `charge`, each attempt costs one bucket token; pass False when `call`
+    draws tokens per request itself.
+    """
+    backoff = 1.0
+    for attempt in range(retries + 1):
+        if charge:
+            await bucket.acquire()
+        try:
+            result = await call()
+        except FloodWaitError as e:
+            if attempt == retries:
+                raise
+            wait = e.seconds + 0.5
+            # Cross-DC auth exports flood hardest; back off harder and slow everyone down
+            if attempt or isinstance(getattr(e, "request", None), ExportAuthorizationRequest):
+                wait += backoff
+                backoff *= 2
+                bucket.slow_down()
+            console.print(f"[yellow]Rate limited. Waiting {wait:.0f}s…[/yellow]")
+            await asyncio.sleep(wait)
+        else:
+            if charge:
+                bucket.note_success()
+            return result
+
+
 # ===================== CORE DOWNLOAD =====================
-async def collect_media_messages(client, chat, media_type: str, limit: int, order: str):
-    collected = []
-    async for msg in client.iter_messages(chat, limit=limit):
-        if not msg or not msg.media:
+async def _fast_download(client, msg, out_path: Path, bucket: AsyncTokenBucket, concurrency: int = 4):
+    """Fetch one file as several byte ranges at once, then move it into place.
+
+    Big documents use separate MTProto connections per range; anything else
+    shares the client's sender through iter_download. Every part request costs
+    one bucket token.
+    """
+    size = msg.file.size
+    parts = -(-size // PART_SIZE)
+    per_range = -(-parts // concurrency)
+    temp = out_path.with_name(out_path.name + ".tmp")
+    write_lock = asyncio.Lock()
+
+    try:
+        async with aiofiles.open(temp, "wb") as f:
+            if msg.document and size > MULTI_SENDER_THRESHOLD:
+                dc_id, location = utils.get_input_location(msg.media)
+                await fast_telethon.download_file(
+                    client, location, f, dc_id, size, workers=concurrency, part_size=PART_SIZE, throttle=bucket
+                )
+            else:
+                async def _range(first_part: int):
+                    offset = first_part * PART_SIZE
+                    end = min(size, (first_part + per_range) * PART_SIZE)
+                    # iter_download issues one GetFile per chunk, so pay before each one
+                    await bucket.acquire()
+                    async for chunk in client.iter_download(
+                        msg.media,
+                        offset=offset,
+                        limit=per_range,
+                        request_size=PART_SIZE,
+                        file_size=size,
+                    ):
+                        async with write_lock:
+                            await f.seek(offset)
+                            await f.write(chunk)
+                        offset += len(chunk)
+                        bucket.note_success()
+                        if offset < end:
+                            await bucket.acquire()
+
+                tasks = [asyncio.create_task(_range(p)) for p in range(0, parts, per_range)]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # Stop the other ranges before the file closes or a FloodWait is slept out
+                    for t in tasks:
+                        t.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+        await asyncio.to_thread(os.replace, temp, out_path)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+
+
+async def collect_media_messages(
+    client, chat, media_type: str, limit: int, order: str, downloaded_ids: Set[int], stats: Dict[str, int]
+) -> AsyncIterator[Message]:
+    """Yield matching media messages as they arrive instead of buffering them.
+
+    Already-downloaded IDs are dropped here and counted in `stats["known"]`.
+    """
+    min_id = 0
+    if order == "oldest":
+        # Same window as newest (the `limit` most recent), walked upwards from its start
+        edge = await client.get_messages(chat, limit=1, add_offset=limit - 1)
+        min_id = edge[0].id - 1 if edge else 0
+    async for msg in client.iter_messages(chat, limit=limit, min_id=min_id, reverse=(order == "oldest")):
+        if not msg:
+            continue
+        if msg.id in downloaded_ids:
+            stats["known"] += 1
+            continue
+        if not msg.media:
             continue
 
         if media_type == "photos":
             if is_photo_message(msg):
-                collected.append(msg)
+                yield msg
         elif media_type == "videos":
             if is_video_message(msg):
-                collected.append(msg)
+                yield msg
         else:  # both
             if is_photo_message(msg) or is_video_message(msg):
-                collected.append(msg)
-
-    if order == "oldest":
-        collected.reverse()
-    return collected
-
-
-async def download_messages(client, chat, messages, chat_folder: Path):
-    downloaded_ids = load_downloaded_set(chat_folder)
+                yield msg
+
+
+async def download_messages(
+    client,
+    chat,
+    messages,
+    chat_folder: Path,
+    downloaded_ids: Set[int],
+    workers: int = DEFAULT_WORKERS,
+    rate: int = DEFAULT_RATE,
+):
     meta = {
         "id": getattr(chat, "id", None),
         "name": getattr(chat, "title", None) or getattr(chat, "username", None) or str(getattr(chat, "id", "")),
@@ -170,46 +391,121 @@ async def download_messages(client, chat, messages, chat_folder: Path):
 
     skipped = 0
     completed = 0
-
-    with progress:
-        task = progress.add_task("download", total=len(messages))
-        for msg in messages:
+    failed = 0
+    processed = 0
+    sem = asyncio.Semaphore(workers)
+    bucket = AsyncTokenBucket(rate, RATE_PERIOD)
+    ids_lock = asyncio.Lock()
+    # Kept sorted for cheap saves; the set stays for O(1) membership checks
+    ordered_ids = SortedList(downloaded_ids)
+    existing = await asyncio.to_thread(snapshot_existing_files, chat_folder)
+    created_dirs: Set[Path] = {chat_folder} | {d for d, _name in existing}
+    dc_senders: Dict[int, object] = {}
+    dc_lock = asyncio.Lock()
+    append_log = open_append_log(chat_folder)
+    recorded = 0
+
+    async def _record(msg_id: int):
+        nonlocal recorded
+        downloaded_ids.add(msg_id)
+        ordered_ids.add(msg_id)
+        append_log.write(f"{msg_id}\n")
+        recorded += 1
+        if recorded % LOG_FSYNC_EVERY == 0:
+            await asyncio.to_thread(os.fsync, append_log.fileno())
+        if recorded % LOG_COMPACT_EVERY == 0:
+            # Callers hold ids_lock, so nothing is appended while the log is truncated
+            await asyncio.to_thread(save_downloaded_set, chat_folder, ordered_ids, meta)
+
+    async def _hold_dc(msg):
+        """Keep one exported sender per media DC open for the whole run."""
+        dc_id = getattr(getattr(msg.file, "media", None), "dc_id", None)
+        if dc_id is None or dc_id == client.session.dc_id or dc_id in dc_senders:
+            return
+        async with dc_lock:
+            if dc_id in dc_senders:
+                return
             try:
-                if msg.id in downloaded_ids:
-                    skipped += 1
-                    progress.advance(task)
-                    continue
+                dc_senders[dc_id] = await with_antiflood(lambda: client._borrow_exported_sender(dc_id), bucket)
+            except Exception:
+                dc_senders[dc_id] = None  # downloads will export on demand
 
-                # If part of an album -> put inside group_{id}
-                if msg.grouped_id:
-                    target_dir = chat_folder / f"group_{msg.grouped_id}"
+    async def _one(msg):
+        nonlocal skipped, completed, failed, processed
+        try:
+            if msg.id in downloaded_ids:
+                skipped += 1
+                return
+
+            # If part of an album -> put inside group_{id}
+            if msg.grouped_id:
+                target_dir = chat_folder / f"group_{msg.grouped_id}"
+                if target_dir not in created_dirs:
                     target_dir.mkdir(parents=True, exist_ok=True)
-                else:
-                    target_dir = chat_folder
-
-                unique_name = build_unique_filename(msg, default_ext=".bin")
-                out_path = target_dir / unique_name
-
-                if out_path.exists():
-                    downloaded_ids.add(msg.id)
-                    skipped += 1
-                    progress.advance(task)
-                    continue
-
-                await msg.download_media(file=str(out_path))
-                downloaded_ids.add(msg.id)
-                completed += 1
-                progress.advance(task)
-
-            except FloodWaitError as e:
-                console.print(f"[yellow]Rate limited. Waiting {e.seconds}s…[/yellow]")
-                await asyncio.sleep(e.seconds)
-            except Exception as e:
-                console.print(f"[red]Error on message {msg.id}: {e}[/red]")
-                progress.advance(task)
-
-    save_downloaded_set(chat_folder, downloaded_ids, meta)
-    return completed, skipped
+                    created_dirs.add(target_dir)
+            else:
+                target_dir = chat_folder
+
+            unique_name = build_unique_filename(msg, default_ext=".bin")
+            out_path = target_dir / unique_name
+
+            if (target_dir, unique_name) in existing:
+                async with ids_lock:
+                    await _record(msg.id)
+                skipped += 1
+                return
+
+            await _hold_dc(msg)
+            if msg.file and (msg.file.size or 0) > FAST_DOWNLOAD_THRESHOLD:
+                await with_antiflood(lambda: _fast_download(client, msg, out_path, bucket), bucket, charge=False)
+            else:
+                await with_antiflood(lambda: msg.download_media(file=str(out_path)), bucket)
+
+            existing.add((target_dir, unique_name))
+            async with ids_lock:
+                await _record(msg.id)
+            completed += 1
+
+        except Exception as e:
+            console.print(f"[red]Error on message {msg.id}: {e}[/red]")
+            failed += 1
+        finally:
+            processed += 1
+            sem.release()
+
+    async def _tick():
+        while True:
+            progress.update(task, completed=processed)
+            await asyncio.sleep(PROGRESS_TICK)
+
+    try:
+        with progress:
+            task = progress.add_task("download", total=None)
+            ticker = asyncio.create_task(_tick())
+            pending = set()
+            try:
+                async for msg in messages:
+                    await sem.acquire()  # backpressure: only `workers` messages in flight
+                    t = asyncio.create_task(_one(msg))
+                    pending.add(t)
+                    t.add_done_callback(pending.discard)
+            except asyncio.CancelledError:
+                for t in pending:
+                    t.cancel()
+                raise
+            finally:
+                # Even if the scan failed, in-flight downloads finish and get recorded
+                await asyncio.gather(*pending, return_exceptions=True)
+                ticker.cancel()
+                progress.update(task, completed=processed)
+    finally:
+        append_log.close()
+        for sender in dc_senders.values():
+            if sender is not None:
+                await client._return_exported_sender(sender)
+        await asyncio.to_thread(save_downloaded_set, chat_folder, ordered_ids, meta)
+
+    return completed, skipped, failed
 
 
 # ===================== UI FLOW =====================
@@ -221,7 +517,7 @@ async def main():
         console.print("[bold]First time setup[/bold]")
         api_id = int(Prompt.ask("Enter your Telegram API ID"))
         api_hash = Prompt.ask("Enter your Telegram API Hash")
-        save_config(api_id, api_hash)
+        await asyncio.to_thread(save_config, api_id, api_hash)
         cfg = {"api_id": api_id, "api_hash": api_hash}
     else:
         console.print(f"Using saved credentials from [i]{CONFIG_FILE}[/i].")
@@ -229,9 +525,13 @@ async def main():
     if Confirm.ask("Do you want to update API credentials?", default=False):
         api_id = int(Prompt.ask("Enter your Telegram API ID"))
         api_hash = Prompt.ask("Enter your Telegram API Hash")
-        save_config(api_id, api_hash)
+        await asyncio.to_thread(save_config, api_id, api_hash)
         cfg = {"api_id": api_id, "api_hash": api_hash}
 
+    SESSION_DIR.mkdir(parents=True, exist_ok=True)
+    legacy_session = Path("session.session")
+    if legacy_session.exists() and not Path(SESSION_NAME + ".session").exists():
+        shutil.move(str(legacy_session), SESSION_NAME + ".session")
     client = TelegramClient(SESSION_NAME, cfg["api_id"], cfg["api_hash"])
     await client.start()
 
@@ -269,34 +569,40 @@ async def main():
     table.add_row("Media type", "photos / videos / both")
     table.add_row("Quantity", "how many recent messages to scan (e.g., 1000)")
     table.add_row("Order", "newest / oldest")
+    table.add_row("Workers", f"parallel downloads (default {DEFAULT_WORKERS})")
+    table.add_row("Rate", f"max Telegram file requests per {RATE_PERIOD}s (default {DEFAULT_RATE})")
     console.print(table)
 
     media_type = Prompt.ask("Media type?", choices=["photos", "videos", "both"], default="both")
     quantity = int(Prompt.ask("How many recent messages to check?", default="500"))
     order = Prompt.ask("Download order?", choices=["newest", "oldest"], default="oldest")
+    workers = max(1, int(Prompt.ask("How many parallel downloads?", default=str(DEFAULT_WORKERS))))
+    rate = max(1, int(Prompt.ask(f"Max requests per {RATE_PERIOD}s?", default=str(DEFAULT_RATE))))
 
     chat_folder = choose_chat_folder(chat)
     console.print(f"[green]Destination:[/green] {chat_folder.resolve()}")
 
-    messages = await collect_media_messages(client, chat, media_type, quantity, order)
-    console.print(f"[cyan]Found {len(messages)} matching media messages.[/cyan]")
-
-    if not messages:
-        console.print("[yellow]Nothing to download with current filters.[/yellow]")
+    if not Confirm.ask("Start downloading now?", default=True):
         await client.disconnect()
         return
 
-    if not Confirm.ask("Start downloading now?", default=True):
+    downloaded_ids = load_downloaded_set(chat_folder)
+    stats = {"known": 0}
+    messages = collect_media_messages(client, chat, media_type, quantity, order, downloaded_ids, stats)
+    completed, skipped, failed = await download_messages(
+        client, chat, messages, chat_folder, downloaded_ids, workers, rate
+    )
+    skipped += stats["known"]
+
+    if not completed and not skipped and not failed:
+        console.print("[yellow]Nothing to download with current filters.[/yellow]")
         await client.disconnect()
         return
 
-    completed, skipped = await download_messages(client, chat, messages, chat_folder)
-    console.print(
-        Panel.fit(
-            f"[bold green]Done![/bold green]\nDownloaded: {completed}\nSkipped (already had): {skipped}",
-            title="Summary",
-        )
-    )
+    summary = f"[bold green]Done![/bold green]\nDownloaded: {completed}\nSkipped (already had): {skipped}"
+    if failed:
+        summary += f"\n[red]Failed: {failed}[/red]"
+    console.print(Panel.fit(summary, title="Summary"))
 
     await client.disconnect()
 